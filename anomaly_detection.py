@@ -1,15 +1,239 @@
 # anomaly_detection.py
-from kusto_connection import extract_dt
+import functools
+import string
+from dataclasses import dataclass
+from kusto_connection import extract_dt, get_query_prelude, kql_identifier, kql_string
 
 
-def generate_series_decomposition_query(base_query, columns, dimension_column=None):
+# Preamble shared by every generated query: the query hints, the base query materialized once so every
+# step of the query reads the same cached result, the time step and the series bounds of the base query
+_SERIES_PREAMBLE = string.Template("""$prelude
+    let base_data = materialize($base_query);
+    let dt = $dt;
+    let bounds = materialize(base_data | summarize min_t = min($time_column), max_t = max($time_column));
+    let min_t = toscalar(bounds | project min_t);
+    let max_t = toscalar(bounds | project max_t);""")
+
+# Preamble declaring the time step and the series bounds as query parameters, defaulting to known values
+_PARAMETERS_PREAMBLE = string.Template("""$prelude
+    declare query_parameters(dt:timespan = $dt, min_t:datetime = datetime($min_t), max_t:datetime = datetime($max_t));
+    let base_data = materialize($base_query);""")
+
+# Series of the materialized base query, optionally filtered and split by dimensions, with a decomposition applied
+_SERIES = string.Template("""
+    base_data$where_clause
+    | make-series $series=avg(todouble($value_column)) on $time_column from min_t to max_t step dt$by_clause
+    | extend $extend_expr""")
+
+# Generators whose queries are cached, see `_cached_query`
+_CACHED_GENERATORS = []
+
+# Anomaly flags of the `num` series, using the threshold chosen in the dashboard
+_ANOMALIES_EXPR = 'Anomalies = series_decompose_anomalies(num, todouble("${AnomalyThreshold}"), -1, \'linefit\')'
+
+
+def _hashable(value):
     """
-    Generates a KQL query for time series decomposition using series_decompose.
-    Decomposes a series to seasonal and trend components.
+    Converts a generator argument to a hashable equivalent: lists become tuples and dicts become tuples of items.
+    """
+
+    if isinstance(value, list):
+        return tuple(value)
+    if isinstance(value, dict):
+        return tuple(sorted(value.items()))
+    return value
+
+
+def _cached_query(generator):
+    """
+    Caches the queries of a generator, keyed on its arguments. Since the generated KQL only depends on the
+    arguments, repeated calls return the already rendered query.
+    """
+
+    cached_generator = functools.lru_cache(maxsize=512)(generator)
+
+    @functools.wraps(generator)
+    def wrapper(*args, **kwargs):
+        return cached_generator(
+            *[_hashable(arg) for arg in args],
+            **{name: _hashable(value) for name, value in kwargs.items()}
+        )
+
+    wrapper.cache_clear = cached_generator.cache_clear
+    _CACHED_GENERATORS.append(wrapper)
+    return wrapper
+
+
+def clear_query_cache():
+    """
+    Clears the cached queries of all the generators, e.g. before building a dashboard on changed data.
+    """
+
+    for generator in _CACHED_GENERATORS:
+        generator.cache_clear()
+    _series_header.cache_clear()
+    _series_query.cache_clear()
+
+
+@functools.lru_cache(maxsize=128)
+def _where_clause_for(dimension_column):
+    """
+    Renders the filter keeping the rows whose dimension value is the one selected in the `${dimension_column}` variable,
+    or an empty string when there is no dimension.
+    """
+
+    if not dimension_column:
+        return ''
+    variable_placeholder = f'${{{dimension_column}}}'
+    return f'\n    | where tostring({kql_identifier(dimension_column)}) == "{variable_placeholder}"'
+
+
+@functools.lru_cache(maxsize=128)
+def _by_clause_for(dimension_column):
+    """
+    Renders the make-series `by` clause splitting the series by the dimension values, or an empty string when there is no dimension.
+    """
+
+    if not dimension_column:
+        return ''
+    dimension = kql_identifier(dimension_column)
+    return f' by {dimension} = tostring({dimension})'
+
+
+@functools.lru_cache(maxsize=128)
+def _dim_projection(dimension_column):
+    """
+    Renders the projection suffix adding the dimension column, or an empty string when there is no dimension.
+    """
+
+    if not dimension_column:
+        return ''
+    return f', {kql_identifier(dimension_column)}'
+
+
+@functools.lru_cache(maxsize=64)
+def _series_header(base_query, time_column, params=None):
+    """
+    Renders the query hints and the statements defining `dt`, `min_t` and `max_t` for the given base query.
+    The header is the same for every panel of a dashboard, so it is rendered once per (base_query, time_column).
+
+    When `params` is given, the three values are declared as query parameters defaulting to the given values,
+    instead of being computed by `let` statements.
+    """
+
+    if params:
+        params = dict(params)
+        return _PARAMETERS_PREAMBLE.substitute(
+            prelude=get_query_prelude(),
+            base_query=base_query,
+            dt=params['dt'],
+            min_t=_kql_datetime(params['min_t']),
+            max_t=_kql_datetime(params['max_t'])
+        )
+
+    return _SERIES_PREAMBLE.substitute(
+        prelude=get_query_prelude(),
+        dt=extract_dt(base_query, time_column),
+        base_query=base_query,
+        time_column=time_column
+    )
+
+
+def _kql_datetime(value):
+    """
+    Formats a datetime (or an already formatted string) for use inside a KQL `datetime(...)` literal.
+    """
+
+    return value.isoformat() if hasattr(value, 'isoformat') else value
+
+
+@functools.lru_cache(maxsize=512)
+def _series_query(time_column, value_column, extend_expr, where_clause='', by_clause='', series='num'):
+    """
+    Renders the make-series step of a generated query. The result is cached, since the same series is rendered for many panels.
+
+    Parameters:
+    - time_column (str): The name of the time column.
+    - value_column (str): The name of the value column.
+    - extend_expr (str): The decomposition expression applied to the series.
+    - where_clause (str, optional): A filter applied to the base query before building the series.
+    - by_clause (str, optional): A `by` clause splitting the series into groups.
+    - series (str, optional): The name of the series column.
+
+    Returns:
+    - series_query (str): The KQL of the series step.
+    """
+
+    return _SERIES.substitute(
+        where_clause=where_clause,
+        series=series,
+        value_column=value_column,
+        time_column=time_column,
+        by_clause=by_clause,
+        extend_expr=extend_expr
+    )
+
+
+@dataclass(frozen=True)
+class PreparedBase:
+    """
+    A base query prepared once for all the generators of a dashboard.
+
+    Attributes:
+    - base_query (str): The base table or query to operate on.
+    - time_column (str): The name of the time column.
+    - value_column (str): The name of the value column.
+    - header (str): The rendered query header, shared by every generated query.
+    """
+
+    base_query: str
+    time_column: str
+    value_column: str
+    header: str
+
+
+def prepare_base(base_query, columns, params=None):
+    """
+    Prepares a base query for the generators, resolving its columns and rendering the shared query header
+    (including the time step lookup) once, instead of once per generated query.
 
     Parameters:
     - base_query (str): The base table or query to operate on.
     - columns (list): A list containing [time_column, value_column].
+    - params (dict, optional): Known values of 'dt' (KQL timespan), 'min_t' and 'max_t' (datetimes). If provided, they are declared as query parameters instead of being computed by the query.
+
+    Returns:
+    - prepared (PreparedBase): The prepared base query, to pass to the generators.
+
+    Raises:
+    - ValueError: If `params` is provided without all of 'dt', 'min_t' and 'max_t'.
+    """
+
+    # Ensure all the query parameters are known, they are declared together
+    if params is not None:
+        missing = [name for name in ('dt', 'min_t', 'max_t') if name not in params]
+        if missing:
+            raise ValueError(f"Missing query parameters: {', '.join(missing)}.")
+
+    # Extract the time and value columns
+    time_column, value_column = columns[0], columns[1]
+
+    return PreparedBase(
+        base_query=base_query,
+        time_column=time_column,
+        value_column=value_column,
+        header=_series_header(base_query, time_column, _hashable(params))
+    )
+
+
+@_cached_query
+def generate_series_decomposition_query(prepared, dimension_column=None):
+    """
+    Generates a KQL query for time series decomposition using series_decompose.
+    Decomposes a series to seasonal and trend components.
+
+    Parameters:
+    - prepared (PreparedBase): The base query prepared by `prepare_base`.
     - dimension_column (str, optional): The name of the dimension column to group by and filter on. If provided, the decomposition will be performed separately for each group defined by this column.
 
     Returns:
@@ -20,98 +244,84 @@ def generate_series_decomposition_query(base_query, columns, dimension_column=No
     """
 
     # Extract the time and value columns
-    time_column = columns[0]
-    value_column = columns[1]
-
-    # Construct the where clause to filter the data based on the dimension column's value
-    where_clause = ''
-    if dimension_column:
-        variable_placeholder = f'${{{dimension_column}}}'
-        where_clause = f'| where tostring({dimension_column}) == "{variable_placeholder}"'
-
-    decomposition_query = f"""
-    let dt = {extract_dt(base_query, time_column)};
-    let min_t = toscalar({base_query} | summarize min({time_column}));
-    let max_t = toscalar({base_query} | summarize max({time_column}));
-    let decomposed_data = {base_query}
-    | make-series num=avg(todouble({value_column})) on {time_column} from min_t to max_t step dt
-    | extend (Baseline, Seasonal, Trend, Residual) = series_decompose(num, -1, 'linefit')
-    | mv-expand {time_column} to typeof(datetime), num to typeof(real), Seasonal to typeof(real), Trend to typeof(real)
-    | project {time_column}, Trend, Seasonal;
-    let joined_data = {base_query}
-    | join kind=leftouter decomposed_data on {time_column};
-    let decomposed_by_{dimension_column} = joined_data
-    | project {time_column}, {value_column}, Seasonal, Trend{', tostring(' + dimension_column + ')' if dimension_column else ''}
-    {where_clause};
-    decomposed_by_{dimension_column}
+    time_column = prepared.time_column
+    value_column = prepared.value_column
+
+    # Construct the where and by clauses to filter the data and split the series by the dimension column's value
+    where_clause = _where_clause_for(dimension_column)
+    by_clause = _by_clause_for(dimension_column)
+    dimension_projection = _dim_projection(dimension_column)
+
+    series_query = _series_query(
+        time_column, value_column,
+        f"(Baseline, Seasonal, Trend, Residual) = series_decompose({value_column}, -1, 'linefit')",
+        where_clause=where_clause, by_clause=by_clause, series=value_column
+    )
+
+    decomposition_query = f"""{prepared.header}{series_query}
+    | mv-expand {time_column} to typeof(datetime), {value_column} to typeof(real), Seasonal to typeof(real), Trend to typeof(real)
+    | project {time_column}, {value_column}, Seasonal, Trend{dimension_projection}
     """.strip()
 
     return decomposition_query
 
 
 
-def generate_series_decompose_anomalies_query(base_query, columns, dimension_column=None):
+@_cached_query
+def generate_series_decompose_anomalies_query(prepared, dimension_column=None):
     """
     Generates a KQL query for detecting anomalies using series_decompose_anomalies.
     Creates a query that performs time series decomposition to identify anomalies.
 
     Parameters:
-    - base_query (str): The base table or query to operate on.
-    - columns (list): A list containing [time_column, value_column].
+    - prepared (PreparedBase): The base query prepared by `prepare_base`.
     - dimension_column (str, optional): The name of the dimension column to group by and filter on. If provided, the decomposition and anomaly detection will be performed separately for each group defined by this column.
 
     Returns:
     - anomalies_query (str): A KQL query that performs anomaly detection.
-    
+
     Notes:
     - When `dimension_column` is provided, the query includes a parameter placeholder `${dimension_column}` for dynamic substitution at execution time.
     """
 
-    time_column = columns[0]
-    value_column = columns[1]
-
-    # Construct the where clause to filter the data based on the dimension column's value
-    where_clause = ''
-    if dimension_column:
-        variable_placeholder = f'${{{dimension_column}}}'
-        where_clause = f'| where tostring({dimension_column}) == "{variable_placeholder}"'
-
-    anomalies_query = f"""
-    let dt = {extract_dt(base_query, time_column)};
-    let min_t = toscalar({base_query} | summarize min({time_column}));
-    let max_t = toscalar({base_query} | summarize max({time_column}));
-    let anomalies_data = {base_query}
-    | make-series num=avg(todouble({value_column})) on {time_column} from min_t to max_t step dt
-    | extend (Anomalies, AnomalyScore) = series_decompose_anomalies(num, todouble("${{AnomalyThreshold}}"), -1, 'linefit')
-    | mv-expand {time_column} to typeof(datetime), Anomalies to typeof(real), AnomalyScore to typeof(real)
-    | project {time_column}, Anomalies, AnomalyScore;
-    let joined_data = {base_query}
-    | join kind=leftouter anomalies_data on {time_column};
-    let anomalies_by_{dimension_column} = joined_data
-    | project {time_column}, {value_column}, Anomalies, AnomalyScore{', tostring(' + dimension_column + ')' if dimension_column else ''}
-    {where_clause};
-    anomalies_by_{dimension_column}
+    time_column = prepared.time_column
+    value_column = prepared.value_column
+
+    # Construct the where and by clauses to filter the data and split the series by the dimension column's value
+    where_clause = _where_clause_for(dimension_column)
+    by_clause = _by_clause_for(dimension_column)
+    dimension_projection = _dim_projection(dimension_column)
+
+    series_query = _series_query(
+        time_column, value_column,
+        f'(Anomalies, AnomalyScore) = series_decompose_anomalies({value_column}, todouble("${{AnomalyThreshold}}"), -1, \'linefit\')',
+        where_clause=where_clause, by_clause=by_clause, series=value_column
+    )
+
+    anomalies_query = f"""{prepared.header}{series_query}
+    | mv-expand {time_column} to typeof(datetime), {value_column} to typeof(real), Anomalies to typeof(real), AnomalyScore to typeof(real)
+    | project {time_column}, {value_column}, Anomalies, AnomalyScore{dimension_projection}
     """.strip()
 
     return anomalies_query
 
 
-def generate_anomaly_count_per_segment_query(base_query, columns, dimension_columns=None):
+@_cached_query
+def generate_anomaly_count_per_segment_query(prepared, dimension_columns=None):
     """
     Generates a KQL query that counts anomalies per segment (columns combinations).
     The function handles different numbers of dimensions and returns a query that can be used to identify segments with the highest number of anomalies.
 
     Parameters:
-    - base_query (str): The base table or query to operate on.
-    - columns (list): A list containing [time_column, value_column].
+    - prepared (PreparedBase): The base query prepared by `prepare_base`.
     - dimension_columns (str, optional): A list of dimension column names to group by. Anomalies will be counted for each combination of dimension values.
 
     Returns:
     - anomaly_count_query (str or None): The generated KQL query string that counts anomalies per segment. Returns None if no dimensions are provided, indicating that the panel should be skipped.
     """
 
-    time_column = columns[0]
-    value_column = columns[1]
+    time_column = prepared.time_column
+    value_column = prepared.value_column
 
     # Ensure dimension_columns is a list
     dimension_columns = dimension_columns or []
@@ -121,79 +331,68 @@ def generate_anomaly_count_per_segment_query(base_query, columns, dimension_colu
         return None
 
     # Prepare the 'by' clause for grouping
-    by_clause = ', '.join(dimension_columns)
-
-    anomaly_count_query = f"""
-    let dt = {extract_dt(base_query, time_column)};
-    let min_t = toscalar({base_query} | summarize min({time_column}));
-    let max_t = toscalar({base_query} | summarize max({time_column}));
-    let anomaly_scores = {base_query}
-    | make-series num=avg(todouble({value_column})) on {time_column} from min_t to max_t step dt
-    | extend Anomalies = series_decompose_anomalies(num, todouble("${{AnomalyThreshold}}"), -1, 'linefit')
-    | mv-expand {time_column} to typeof(datetime), Anomalies to typeof(real)
-    | project {time_column}, Anomalies;
-    {base_query}
-    | join kind=leftouter anomaly_scores on {time_column}
+    by_clause = ', '.join(kql_identifier(dimension) for dimension in dimension_columns)
+
+    series_query = _series_query(
+        time_column, value_column, _ANOMALIES_EXPR, by_clause=f' by {by_clause}'
+    )
+
+    anomaly_count_query = f"""{prepared.header}{series_query}
+    | mv-expand Anomalies to typeof(real)
     | where Anomalies == 1
-    | summarize AnomalyCount = count() by Anomalies, {by_clause}
+    | summarize AnomalyCount = count() by {by_clause}
     | project AnomalyCount, {by_clause}
     | sort by AnomalyCount desc""".strip()
 
     return anomaly_count_query
 
 
-def generate_anomaly_count_bar_chart(base_query, columns, dimension_column):
+@_cached_query
+def generate_anomaly_count_bar_chart(prepared, dimension_column):
     """
     Generates a KQL query for counting anomalies per a single dimension.
 
     Parameters:
-    - base_query (str): The base table or query to operate on.
-    - columns (list): A list containing [time_column, value_column].
+    - prepared (PreparedBase): The base query prepared by `prepare_base`.
     - dimension_column (str, optional): The name of the dimension column to group by. Anomalies will be counted for each unique value in this column.
 
     Returns:
     - barplot_query (str): A KQL query string that counts anomalies for each category per a specified dimension.
     """
 
-    time_column = columns[0]
-    value_column = columns[1]
-
-    barplot_query = f"""
-    let dt = {extract_dt(base_query, time_column)};
-    let min_t = toscalar({base_query} | summarize min({time_column}));
-    let max_t = toscalar({base_query} | summarize max({time_column}));
-    let anomalies_data = {base_query}
-    | make-series num=avg(todouble({value_column})) on {time_column} from min_t to max_t step dt
-    | extend Anomalies = series_decompose_anomalies(num, todouble("${{AnomalyThreshold}}"), -1, 'linefit')
-    | mv-expand {time_column} to typeof(datetime), Anomalies to typeof(real)
-    | project {time_column}, Anomalies;
-    let joined_data = {base_query}
-    | join kind=leftouter anomalies_data on {time_column}
-    | where Anomalies == 1;
-    let anomalies_by_{dimension_column} = joined_data
-    | summarize AnomalyCount = count() by tostring({dimension_column})
-    | extend Category = tostring({dimension_column});
-    anomalies_by_{dimension_column}
+    time_column = prepared.time_column
+    value_column = prepared.value_column
+
+    series_query = _series_query(
+        time_column, value_column, _ANOMALIES_EXPR,
+        by_clause=_by_clause_for(dimension_column)
+    )
+
+    barplot_query = f"""{prepared.header}{series_query}
+    | mv-expand Anomalies to typeof(real)
+    | where Anomalies == 1
+    | summarize AnomalyCount = count() by {kql_identifier(dimension_column)}
+    | extend Category = {kql_identifier(dimension_column)}
     """.strip()
 
     return barplot_query
 
 
-def generate_dimension_anomaly_barchart(base_query, columns, dimension_columns=None):
+@_cached_query
+def generate_dimension_anomaly_barchart(prepared, dimension_columns=None):
     """
     Generates a KQL query for counting anomalies per dimension.
 
     Parameters:
-    - base_query (str): The base table or query to operate on.
-    - columns (list): A list containing [time_column, value_column].
+    - prepared (PreparedBase): The base query prepared by `prepare_base`.
     - dimension_columns (list, optional): A list of dimension column names. Anomalies will be counted for each dimension.
 
     Returns:
     - barchart_query (str): A KQL query string that counts anomalies for each dimension.
     """
 
-    time_column = columns[0]
-    value_column = columns[1]
+    time_column = prepared.time_column
+    value_column = prepared.value_column
 
     # Ensure dimension_columns is a list
     dimension_columns = dimension_columns or []
@@ -202,35 +401,26 @@ def generate_dimension_anomaly_barchart(base_query, columns, dimension_columns=N
     if not dimension_columns:
         return None
 
-    # Construct the projection of dimension columns
-    dimension_projection = ''.join([f", {col}" for col in dimension_columns])
-
-    barchart_query = f"""
-    let dt = {extract_dt(base_query, time_column)};
-    let min_t = toscalar({base_query} | summarize min({time_column}));
-    let max_t = toscalar({base_query} | summarize max({time_column}));
-    let anomalies_data = {base_query}
-    | make-series num=avg(todouble({value_column})) on {time_column} from min_t to max_t step dt
-    | extend Anomalies = series_decompose_anomalies(num, todouble("${{AnomalyThreshold}}"), -1, 'linefit')
-    | mv-expand {time_column} to typeof(datetime), Anomalies to typeof(real)
-    | project {time_column}, Anomalies;
-    let joined_data = {base_query}
-    | join kind=leftouter anomalies_data on {time_column}
+    # Count the anomalies of the series split by each dimension
+    dimension_queries = []
+    for index, dimension in enumerate(dimension_columns):
+        series_query = _series_query(
+            time_column, value_column, _ANOMALIES_EXPR,
+            by_clause=_by_clause_for(dimension)
+        )
+        dimension_queries.append(f"""
+    let anomalies_by_dimension_{index} = {series_query.strip()}
+    | mv-expand Anomalies to typeof(real)
     | where Anomalies == 1
-    | project {time_column}, Anomalies{dimension_projection};
-    """
-
-    # Add anomalies summarization for each dimension
-    for dimension in dimension_columns:
-        barchart_query += f"""
-    let anomalies_by_{dimension} = joined_data
-    | summarize AnomalyCount = count() by Dimension = '{dimension}';
-    """
+    | summarize AnomalyCount = count() by Dimension = {kql_string(dimension)};""")
 
     # Combine the results using union
-    union_queries = ' | union '.join([f'anomalies_by_{dimension}' for dimension in dimension_columns])
-    barchart_query += f"""
-    {union_queries}
-    """
+    union_queries = ' | union '.join([f'anomalies_by_dimension_{index}' for index in range(len(dimension_columns))])
+
+    barchart_query = ''.join([
+        prepared.header,
+        *dimension_queries,
+        f"\n    {union_queries}"
+    ])
 
     return barchart_query.strip()
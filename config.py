@@ -3,8 +3,10 @@
 import os
 from dotenv import load_dotenv
 
-# Load variables from .env file into environment
-load_dotenv(override=True)
+# Load variables from .env file into environment, once for this process and any child process it starts
+if not os.environ.get("_DOTENV_LOADED"):
+    load_dotenv(override=True)
+    os.environ["_DOTENV_LOADED"] = "1"
 
 # Database configurations
 DATABASE = os.getenv("DATABASE")
@@ -22,3 +24,26 @@ DATASOURCE_NAME = os.getenv('DATASOURCE_NAME')
 
 # Base query to be used for the dashboard
 BASE_QUERY = os.getenv("BASE_QUERY")
+
+# Query hints prepended to the generated KQL: results cache max age (empty to disable) and weak consistency
+QUERY_CACHE_MAX_AGE = os.getenv("QUERY_CACHE_MAX_AGE", "5m")
+QUERY_WEAK_CONSISTENCY = os.getenv("QUERY_WEAK_CONSISTENCY", "true").lower() == "true"
+
+# Settings that must be set for a dashboard to be created
+_REQUIRED_SETTINGS = (
+    "APP_ID", "APP_KEY", "AUTHORITY_ID",
+    "API_TOKEN", "GRAFANA_URL", "DATASOURCE_NAME", "BASE_QUERY"
+)
+
+
+def validate():
+    """
+    Ensures all the required settings are set.
+
+    Raises:
+    - EnvironmentError: If any required setting is missing, naming every missing setting at once.
+    """
+
+    missing = [name for name in _REQUIRED_SETTINGS if not globals()[name]]
+    if missing:
+        raise EnvironmentError(f"Environment variables not set: {', '.join(missing)}.")
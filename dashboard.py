@@ -1,26 +1,237 @@
 # dashboard.py
 
-import json
+from dataclasses import dataclass
+from typing import Optional
+import itertools
+import logging
+import orjson
 import requests
 import config
 import re
 
+logger = logging.getLogger(__name__)
+
+# HTTP session reused across Grafana API calls, keeping connections open between dashboards
+_SESSION = requests.Session()
+
+# Characters not allowed in a dashboard UID
+_UID_RE = re.compile(r'\W+')
+
+# Heights of rows and regular panels in grid units
+_ROW_HEIGHT = 1
+_PANEL_HEIGHT = 8
+
+# Grafana plugin type of the Azure Data Explorer data source
+_DATASOURCE_TYPE = "grafana-azure-data-explorer-datasource"
+
+# Constant parts of a panel query target
+_TARGET_TEMPLATE = {
+    "refId": "A",
+    "queryType": "KQL",
+    "querySource": "raw",
+    "rawMode": True
+}
+
+# Query result format per panel type, defaulting to "table"
+_RESULT_FORMAT_BY_TYPE = {
+    'timeseries': "time_series"
+}
+
+# Default panel options (legend and tooltip)
+_PANEL_OPTIONS = {
+    "legend": {
+        "displayMode": "list",
+        "placement": "bottom",
+        "showLegend": True
+    },
+    "tooltip": {
+        "mode": "single",
+        "sort": "none"
+    }
+}
+
+# Panel options per panel type, defaulting to _PANEL_OPTIONS
+_OPTIONS_BY_TYPE = {
+    # Configuration for bar chart panels
+    'barchart': {
+        **_PANEL_OPTIONS,
+        "stacking": "none",
+        "orientation": "auto"
+    },
+    # Configuration for table panels
+    'table': {
+        "showHeader": True,
+        "fontSize": "100%",
+        "sortBy": []
+    }
+}
+
+# Custom field configuration per panel type
+_CUSTOM_BY_TYPE = {
+    # Configuration for timeseries panels
+    'timeseries': {
+        "drawStyle": "line",
+        "lineInterpolation": "linear",
+        "lineWidth": 1,
+        "fillOpacity": 0,
+        "pointSize": 5,
+        "showPoints": "auto",
+        "barWidthFactor": 0.6,
+        "gradientMode": "none"
+    },
+    # Configuration for bar chart panels
+    'barchart': {
+        "drawStyle": "bar",
+        "barAlignment": 0,
+        "barWidthFactor": 0.97,
+        "fillOpacity": 80
+    }
+}
+
+
+@dataclass(slots=True)
+class Panel:
+    """
+    A panel (or row) of the dashboard, in display order.
+
+    Attributes:
+    - title (str): The title of the panel.
+    - type (str): The Grafana panel type ('row', 'timeseries', 'barchart' or 'table').
+    - query (str, optional): The KQL query of the panel. Rows have no query.
+    - repeat (str, optional): The name of the variable the panel is repeated for.
+    - collapsed (bool): Whether a row is collapsed.
+    """
+
+    title: str
+    type: str
+    query: Optional[str] = None
+    repeat: Optional[str] = None
+    collapsed: bool = False
+
 
 def add_row(queries_and_titles, title):
     """
     Adds a row to the dashboard configuration.
 
     Parameters:
-    - queries_and_titles (list): The list of queries and titles for the dashboard panels.
+    - queries_and_titles (list): The list of Panel objects of the dashboard.
     - title (str): The title of the row to add.
     """
 
-    queries_and_titles.append({
-        'title': title,
-        'type': 'row',
-        'collapsed': False,
-        'panels': []
-    })
+    queries_and_titles.append(Panel(title=title, type='row'))
+
+
+def _build_row(item, panel_id, y_position):
+    """
+    Builds the Grafana definition of a row.
+
+    Parameters:
+    - item (Panel): The row entry of queries_and_titles.
+    - panel_id (int): The ID of the row.
+    - y_position (int): The vertical position of the row.
+
+    Returns:
+    - row_panel (dict): The row definition.
+    """
+
+    return {
+        "type": "row",
+        "title": item.title,
+        "collapsed": item.collapsed,
+        "gridPos": {
+            "h": _ROW_HEIGHT, # Height of the row
+            "w": 24, # Full width
+            "x": 0, # Start at left
+            "y": y_position
+        },
+        "panels": [],
+        "id": panel_id
+    }
+
+
+def _build_panel(item, panel_id, y_position, datasource, database):
+    """
+    Builds the Grafana definition of a regular panel, sharing the constant parts of the panel definition.
+
+    Parameters:
+    - item (Panel): The panel entry of queries_and_titles.
+    - panel_id (int): The ID of the panel.
+    - y_position (int): The vertical position of the panel.
+    - datasource (dict): The data source of the panel and its query.
+    - database (str): The name of the database to query.
+
+    Returns:
+    - panel (dict): The panel definition.
+    """
+
+    panel_type = item.type
+    panel = {
+        "type": panel_type,
+        "title": item.title,
+        "id": panel_id,
+        "gridPos": {
+            "h": _PANEL_HEIGHT,  # Standard height for panels
+            "w": 24,
+            "x": 0,
+            "y": y_position
+        },
+        "datasource": datasource,
+        "targets": [
+            {
+                **_TARGET_TEMPLATE,
+                "datasource": datasource,
+                "database": database,
+                "resultFormat": _RESULT_FORMAT_BY_TYPE.get(panel_type, "table"),
+                "query": item.query
+            }
+        ],
+        "fieldConfig": {
+            "defaults": {},
+            "overrides": []
+        },
+        "options": _OPTIONS_BY_TYPE.get(panel_type, _PANEL_OPTIONS),
+        "pluginVersion": "5.0.7"
+    }
+
+    # If the panel should be repeated (for variables)
+    if item.repeat:
+        panel['repeat'] = item.repeat
+        panel['repeatDirection'] = 'h' # Horizontal repetition
+        panel['maxPerRow'] = 6  # Maximum panels per row (adjustable)
+
+    # Add specific field configuration based on panel type
+    if panel_type in _CUSTOM_BY_TYPE:
+        panel['fieldConfig']['defaults']['custom'] = _CUSTOM_BY_TYPE[panel_type]
+    elif panel_type == 'table':
+        panel['fieldConfig']['defaults']['align'] = "auto"
+
+    return panel
+
+
+def _iter_dashboard_body(dashboard, panels):
+    """
+    Serializes the body of the dashboard request chunk by chunk, one panel at a time,
+    so neither the full list of panel definitions nor the full body is held in memory.
+
+    Parameters:
+    - dashboard (dict): The dashboard definition, without its panels.
+    - panels (iterable): The panel definitions, built lazily.
+
+    Yields:
+    - chunk (bytes): The next chunk of the JSON body.
+    """
+
+    # Open the body and the dashboard, leaving the dashboard object open for its panels
+    yield b'{"folderId":0,"overwrite":true,"dashboard":' + orjson.dumps(dashboard)[:-1] + b',"panels":['
+
+    # Serialize each panel as it is built, separated by commas
+    for index, panel in enumerate(panels):
+        if index:
+            yield b','
+        yield orjson.dumps(panel)
+
+    # Close the panels list, the dashboard and the body
+    yield b']}}'
 
 
 def create_dashboard(queries_and_titles, variable_definitions, dashboard_title, datasource_name, database):
@@ -28,19 +239,43 @@ def create_dashboard(queries_and_titles, variable_definitions, dashboard_title,
     Creates a Grafana dashboard (JSON format) based on the provided queries and configurations, and sends it to the Grafana API.
 
     Parameters:
-    - queries_and_titles (list): A list of dictionaries containing queries and titles for the panels.
+    - queries_and_titles (list): A list of Panel objects containing queries and titles for the panels.
     - variable_definitions (list): A list of variable definitions for Grafana templating.
     - dashboard_title (str): The title of the dashboard to be created.
     - datasource_name (str): The UID of the Grafana data source to use.
     - database (str): The name of the database to query.
     """
+    # Drop the panels identical to an earlier one (same type, query and repeat), they would show the same data
+    seen_panels = set()
+    unique_items = []
+    for item in queries_and_titles:
+        if item.type != 'row':
+            key = (item.type, item.query, item.repeat)
+            if key in seen_panels:
+                continue
+            seen_panels.add(key)
+        unique_items.append(item)
+    queries_and_titles = unique_items
+
+    # Skip the dashboard when there is nothing to show but rows
+    if not any(item.type != 'row' for item in queries_and_titles):
+        logger.warning("Dashboard '%s' has no panels, skipping creation", dashboard_title)
+        return None
+
+    # Get Grafana API details from environment variables
+    grafana_url = config.GRAFANA_URL
+    api_token = config.API_TOKEN
+
+    if not grafana_url or not api_token:
+        logger.error("Cannot create dashboard '%s': GRAFANA_URL or API_TOKEN is not set", dashboard_title)
+        return None
+
     # Initialize the dashboard structure
-    dashboard_uid = re.sub(r'\W+', '-', dashboard_title.lower()).strip('-')
+    dashboard_uid = _UID_RE.sub('-', dashboard_title.lower()).strip('-')
 
     dashboard = {
         "uid": dashboard_uid,
         "title": dashboard_title,
-        "panels": [],
         "templating": {
             "list": variable_definitions
         },
@@ -56,134 +291,25 @@ def create_dashboard(queries_and_titles, variable_definitions, dashboard_title,
         "weekStart": ""
     }
 
-    # Initialize panel ID and grid position counters
-    panel_id = 1
-    y_position = 0 # Used to position panels vertically
-
-    for item in queries_and_titles:
-        if item['type'] == 'row':
-            # Handle row panel
-            row_panel = {
-                "type": "row",
-                "title": item['title'],
-                "collapsed": item.get('collapsed', False),
-                "gridPos": {
-                    "h": 1, # Height of the row
-                    "w": 24, # Full width
-                    "x": 0, # Start at left
-                    "y": y_position
-                },
-                "panels": [],
-                "id": panel_id
-            }
-            dashboard['panels'].append(row_panel)
-            panel_id += 1
-            y_position += 1  # Rows typically have a height of 1
-        else:
-            # Handle regular panels
-            panel = {
-                "type": item['type'],
-                "title": item['title'],
-                "id": panel_id,
-                "gridPos": {
-                    "h": 8,  # Standard height for panels
-                    "w": 24, 
-                    "x": 0, 
-                    "y": y_position
-                },
-                "datasource": {
-                    "type": "grafana-azure-data-explorer-datasource",
-                    "uid": datasource_name
-                },
-                "targets": [
-                    {
-                        "refId": "A",
-                        "datasource": {
-                            "type": "grafana-azure-data-explorer-datasource",
-                            "uid": datasource_name
-                        },
-                        "database": database,
-                        "queryType": "KQL",
-                        "querySource": "raw",
-                        "rawMode": True,
-                        "resultFormat": "time_series" if item['type'] == 'timeseries' else "table",
-                        "query": item['query']
-                    }
-                ],
-                "fieldConfig": {
-                    "defaults": {},
-                    "overrides": []
-                },
-                "options": {
-                    "legend": {
-                        "displayMode": "list",
-                        "placement": "bottom",
-                        "showLegend": True
-                    },
-                    "tooltip": {
-                        "mode": "single",
-                        "sort": "none"
-                    }
-                },
-                "pluginVersion": "5.0.7"
-            }
-
-            # If the panel should be repeated (for variables)
-            if item.get('repeat'):
-                panel['repeat'] = item['repeat']
-                panel['repeatDirection'] = 'h' # Horizontal repetition
-                panel['maxPerRow'] = 6  # Maximum panels per row (adjustable)
-
-            # Add specific options based on panel type
-            if item['type'] == 'timeseries':
-                # Configuration for timeseries panels
-                panel['fieldConfig']['defaults']['custom'] = {
-                    "drawStyle": "line",
-                    "lineInterpolation": "linear",
-                    "lineWidth": 1,
-                    "fillOpacity": 0,
-                    "pointSize": 5,
-                    "showPoints": "auto",
-                    "barWidthFactor": 0.6,
-                    "gradientMode": "none"
-                }
-            elif item['type'] == 'barchart':
-                # Configuration for bar chart panels
-                panel['fieldConfig']['defaults']['custom'] = {
-                    "drawStyle": "bar",
-                    "barAlignment": 0,
-                    "barWidthFactor": 0.97,
-                    "fillOpacity": 80
-                }
-                panel['options']['stacking'] = "none"
-                panel['options']['orientation'] = "auto"
-            elif item['type'] == 'table':
-                # Configuration for table panels
-                panel['options'] = {
-                    "showHeader": True,
-                    "fontSize": "100%",
-                    "sortBy": []
-                }
-                panel['fieldConfig']['defaults']['align'] = "auto"
-
-            # Add the configured panel to the dashboard
-            dashboard['panels'].append(panel)
-            panel_id += 1
-            y_position += 8  # Increment y_position based on panel height
-
-    # Prepare the dashboard JSON
-    dashboard_json = {
-        "dashboard": dashboard,
-        "folderId": 0,
-        "overwrite": True
+    # Data source shared by every panel and query target
+    datasource = {
+        "type": _DATASOURCE_TYPE,
+        "uid": datasource_name
     }
 
-    # Convert the dashboard dictionary to JSON
-    dashboard_json_str = json.dumps(dashboard_json)
+    # Compute the vertical position of each panel from the heights of the panels above it
+    heights = [_ROW_HEIGHT if item.type == 'row' else _PANEL_HEIGHT for item in queries_and_titles]
+    y_positions = itertools.accumulate(heights, initial=0)
 
-    # Get Grafana API details from environment variables
-    grafana_url = config.GRAFANA_URL
-    api_token = config.API_TOKEN
+    # Build the panels lazily, numbering them from 1
+    panels = (
+        _build_row(item, panel_id, y_position) if item.type == 'row'
+        else _build_panel(item, panel_id, y_position, datasource, database)
+        for panel_id, (item, y_position) in enumerate(zip(queries_and_titles, y_positions), start=1)
+    )
+
+    # Serialize the dashboard JSON as it is sent
+    dashboard_body = _iter_dashboard_body(dashboard, panels)
 
     # Set up the HTTP headers with the API token for authentication
     headers = {
@@ -191,15 +317,15 @@ def create_dashboard(queries_and_titles, variable_definitions, dashboard_title,
         "Content-Type": "application/json"
     }
 
-    # Send the dashboard JSON to Grafana via the API
-    response = requests.post(
+    # Stream the dashboard JSON to Grafana via the API (sent with chunked transfer encoding)
+    response = _SESSION.post(
         f"{grafana_url}/api/dashboards/db",
         headers=headers,
-        data=dashboard_json_str
+        data=dashboard_body
     )
 
     # Check the response
     if response.status_code == 200:
-        print(f"Dashboard '{dashboard_title}' created successfully")
+        logger.info("Dashboard '%s' created successfully", dashboard_title)
     else:
-        print(f"Failed to create dashboard '{dashboard_title}': {response.text}")
\ No newline at end of file
+        logger.error("Failed to create dashboard '%s': %s", dashboard_title, response.text)
\ No newline at end of file
@@ -1,8 +1,24 @@
-from azure.kusto.data import KustoClient, KustoConnectionStringBuilder
-from azure.kusto.data.helpers import dataframe_from_result_table
 import config
+import functools
 import re
-import pandas as pd
+import threading
+import time
+
+
+# Patterns used to parse the base query
+_COMMENT_RE = re.compile(r'//.*')
+_NAME_RE = re.compile(r"\[\s*'((?:[^'\\]|\\.)*)'\s*\]|[A-Za-z_][A-Za-z0-9_]*")
+_IDENTIFIER_RE = re.compile(r'[A-Za-z_][A-Za-z0-9_]*')
+
+# Units used to format a time step, with their length in seconds
+_TIME_UNITS = (('d', 86400), ('h', 3600), ('m', 60), ('s', 1))
+
+# How long Kusto metadata (table names, query columns) is reused before being fetched again, in seconds
+_METADATA_TTL = 300
+
+# Shared KustoClient, created on first use
+_query_client = None
+_query_client_lock = threading.Lock()
 
 
 def get_query_client():
@@ -12,19 +28,103 @@ def get_query_client():
     The client is authenticated using Azure Active Directory (AAD) application key authentication,
     utilizing credentials provided in the `config` module.
 
+    The client is created once and reused by every subsequent call, so all queries share
+    its connection pool and AAD token cache. Creation is guarded by a lock so concurrent
+    callers never build more than one client.
+
     Returns:
     KustoClient: An authenticated KustoClient connected to the specified cluster.
     """
-    
-    query_kcsb = KustoConnectionStringBuilder.with_aad_application_key_authentication(
-        config.QUERY_CLUSTER, config.APP_ID, config.APP_KEY, config.AUTHORITY_ID
-    )
-    return KustoClient(query_kcsb)
+    global _query_client
+
+    with _query_client_lock:
+        if _query_client is None:
+            # Load the Kusto SDK only when a client is first needed
+            from azure.kusto.data import KustoClient, KustoConnectionStringBuilder
+
+            query_kcsb = KustoConnectionStringBuilder.with_aad_application_key_authentication(
+                config.QUERY_CLUSTER, config.APP_ID, config.APP_KEY, config.AUTHORITY_ID
+            )
+            _query_client = KustoClient(query_kcsb)
+
+    return _query_client
+
+
+def execute_query(query):
+    """
+    Executes a read-only KQL query against the configured database, prefixed with the query hints of `get_query_prelude`.
+
+    The request is flagged as read-only, so Kusto rejects it if it would write anything.
+
+    Parameters:
+    - query (str): The KQL query to execute.
+
+    Returns:
+    KustoResponseDataSet: The response of the query.
+    """
+
+    from azure.kusto.data import ClientRequestProperties
+
+    properties = ClientRequestProperties()
+    properties.set_option("request_readonly", True)
+
+    client = get_query_client()
+    return client.execute(config.DATABASE, f"{get_query_prelude()}\n{query}", properties)
+
+
+def get_query_prelude():
+    """
+    Builds the `set` statements prepended to generated queries, as configured in the `config` module.
+
+    The statements let Kusto serve repeated queries (e.g. dashboard refreshes) from its query results
+    cache and run them with weak consistency, which spreads the load across the cluster nodes.
+
+    Returns:
+    - str: The `set` statements separated by newlines, or an empty string if none are enabled.
+    """
+
+    statements = []
+    if config.QUERY_CACHE_MAX_AGE:
+        statements.append(f"set query_results_cache_max_age = time({config.QUERY_CACHE_MAX_AGE});")
+    if config.QUERY_WEAK_CONSISTENCY:
+        statements.append("set queryconsistency = 'weakconsistency';")
+
+    return '\n'.join(statements)
+
+
+def _metadata_cache(function):
+    """
+    Caches the results of a Kusto metadata lookup for `_METADATA_TTL` seconds,
+    keyed on the cluster, the database and the arguments of the lookup.
+    """
+
+    cache = {}
+    cache_lock = threading.Lock()
+
+    @functools.wraps(function)
+    def wrapper(*args):
+        key = (config.QUERY_CLUSTER, config.DATABASE, args)
+        now = time.monotonic()
+
+        with cache_lock:
+            entry = cache.get(key)
+        if entry and now - entry[0] < _METADATA_TTL:
+            return entry[1]
+
+        result = function(*args)
+        with cache_lock:
+            cache[key] = (now, result)
+
+        return result
 
+    wrapper.cache_clear = cache.clear
+    return wrapper
 
+
+@_metadata_cache
 def get_all_table_names():
     """
-    Retrieves all table names from a Kusto database.
+    Retrieves all table names from a Kusto database. Results are cached for a few minutes.
 
     Returns:
     table_names (list): A list of all table names in the database.
@@ -42,9 +142,10 @@ def get_all_table_names():
     return table_names
 
 
+@_metadata_cache
 def get_query_columns_from_query(base_query):
     """
-    Retrieves the column names resulting from a given Kusto query.
+    Retrieves the column names resulting from a given Kusto query. Results are cached for a few minutes.
 
     Parameters:
     base_query (str): The Kusto query to execute.
@@ -53,8 +154,8 @@ def get_query_columns_from_query(base_query):
     columns (list): A list of the column names from the query result.
     """
 
-    client = get_query_client()
-    response = client.execute(config.DATABASE, base_query)
+    # Only the schema is needed, so no rows are fetched
+    response = execute_query(f"{base_query}\n| take 0")
 
     # Extract column names from the response
     table = response.primary_results[0]
@@ -63,68 +164,123 @@ def get_query_columns_from_query(base_query):
     return columns
 
 
+def get_dimension_values(base_query, dimension_columns):
+    """
+    Retrieves the distinct values of every dimension column in a single Kusto query.
+
+    Parameters:
+    - base_query (str): The base KQL query.
+    - dimension_columns (list): The names of the dimension columns.
+
+    Returns:
+    - dimension_values (dict): The sorted distinct values (as strings) of each dimension column, keyed by column name.
+    """
+
+    dimension_values = {dimension_column: [] for dimension_column in dimension_columns}
+    if not dimension_columns:
+        return dimension_values
+
+    # Read the base query once and label the distinct values of each dimension with its name
+    distinct_queries = ',\n    '.join(
+        f"(data | summarize by Value = tostring({kql_identifier(dimension_column)}) | extend Dimension = {index})"
+        for index, dimension_column in enumerate(dimension_columns)
+    )
+    query = f"""
+    let data = materialize({base_query});
+    union
+    {distinct_queries}
+    """
+
+    response = execute_query(query)
+
+    # Split the rows back into the values of each dimension
+    for row in response.primary_results[0].rows:
+        dimension_values[dimension_columns[row['Dimension']]].append(row['Value'])
+
+    for values in dimension_values.values():
+        values.sort()
+
+    return dimension_values
+
+
+@functools.lru_cache(maxsize=256)
 def extract_dt(base_query, timestamp_column):
     """
     Extracts the time difference between the two most recent entries from a base query using KQL.
+    Results are cached per (base_query, timestamp_column); call `extract_dt.cache_clear()` to refresh.
     Parameters:
     - base_query (str): The base KQL query to execute.
     - timestamp_column (str): The name of the timestamp column.
     Returns:
     - str: The time difference between the two most recent timestamps.
     """
-    client = get_query_client()
     # Construct the KQL query to calculate the time difference
     query = f"""
     let data = ({base_query});
     data
-    | sort by {timestamp_column} desc
+    | top 2 by {timestamp_column} desc
     | extend NextTimestamp = next({timestamp_column})
     | where isnotnull(NextTimestamp)
     | take 1
     | project TimeDifference = {timestamp_column} - NextTimestamp
     """
     # Execute the query
-    response = client.execute(config.DATABASE, query)
+    response = execute_query(query)
 
     # Check if the response contains data
     if not response.primary_results or len(response.primary_results) == 0:
         return None  # Or handle the case as needed
 
     result_table = response.primary_results[0]
-    result_df = dataframe_from_result_table(result_table)
 
-    if result_df.empty:
+    if not result_table.rows:
         return None  # Or handle the case as needed
 
-    # Get the TimeDifference value
-    time_diff_str = result_df['TimeDifference'][0]
-
-    # Convert the time difference string to a pandas Timedelta object
-    time_difference = pd.Timedelta(time_diff_str)
+    # Get the TimeDifference value straight from the single result row, parsed by the SDK as a timedelta
+    time_difference = result_table.rows[0]['TimeDifference']
 
     # Decompose the time delta into days, hours, minutes, and seconds
-    days = time_difference.days
-    seconds = time_difference.seconds
-    hours = seconds // 3600
-    minutes = (seconds % 3600) // 60
-    secs = seconds % 60
-
-    # Build the output string
+    remaining = int(time_difference.total_seconds())
     time_components = []
-    if days > 0:
-        time_components.append(f"{days}d")
-    if hours > 0:
-        time_components.append(f"{hours}h")
-    if minutes > 0:
-        time_components.append(f"{minutes}m")
-    if secs > 0:
-        time_components.append(f"{secs}s")
+    for unit, size in _TIME_UNITS:
+        count, remaining = divmod(remaining, size)
+        if count:
+            time_components.append(f"{count}{unit}")
+
+    return ' '.join(time_components) or "1d"
+
+
+
+def kql_identifier(name):
+    """
+    Canonicalizes a column name for use in KQL.
+
+    Parameters:
+    - name (str): The column name.
+
+    Returns:
+    - str: The name itself if it is a plain identifier, otherwise the name quoted as `['name']`.
+    """
+
+    if _IDENTIFIER_RE.fullmatch(name):
+        return name
+
+    return f"[{kql_string(name)}]"
+
 
-    if not time_components:
-        return "1d"
+def kql_string(value):
+    """
+    Quotes a value as a single-quoted KQL string literal.
+
+    Parameters:
+    - value (str): The value to quote.
 
-    return ' '.join(time_components)
+    Returns:
+    - str: The value quoted as `'value'`, with its backslashes, single quotes and line breaks escaped.
+    """
 
+    escaped_value = value.replace('\\', '\\\\').replace("'", "\\'").replace('\n', '\\n').replace('\r', '\\r')
+    return f"'{escaped_value}'"
 
 
 def extract_table_name(base_query, table_names):
@@ -139,17 +295,17 @@ def extract_table_name(base_query, table_names):
     - table_name (str): The extracted table name or 'Custom Query' if not found.
     """
 
-    # Remove comments and extra spaces
-    query = re.sub(r'//.*', '', base_query).strip()
+    # Remove comments
+    query = _COMMENT_RE.sub('', base_query)
 
-    # Split the query into tokens
-    tokens = re.split(r'\s+|\n+|\|', query)
+    # Use a set so each name is matched in constant time
+    table_names = frozenset(table_names)
 
-    # Attempt to find a token that matches a table name
-    for token in tokens:
-        token = token.strip()
-        if token in table_names:
-            return token
+    # Scan the names of the query (plain or quoted as ['name']) in a single pass, and return the first table name
+    for match in _NAME_RE.finditer(query):
+        name = match.group(1) if match.group(1) is not None else match.group(0)
+        if name in table_names:
+            return name
 
     # Raise an error if no table name is found in the query
     raise ValueError("The given query does not reference any table in the provided database.")
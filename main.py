@@ -1,22 +1,75 @@
 # main.py
 
+from concurrent.futures import ThreadPoolExecutor
+import logging
 import config
-from anomaly_detection import (
-    generate_series_decomposition_query,
-    generate_series_decompose_anomalies_query,
-    generate_anomaly_count_per_segment_query,
-    generate_anomaly_count_bar_chart,
-    generate_dimension_anomaly_barchart,
-)
-from dashboard import (
-    create_dashboard,
-      add_row
-)
-from kusto_connection import (
-    get_query_columns_from_query,
-    get_all_table_names,
-    extract_table_name
-)
+
+logger = logging.getLogger(__name__)
+
+# Constant parts of a dimension variable definition
+_DIMENSION_VARIABLE_TEMPLATE = {
+    "type": "custom",
+    "hide": 0,
+    "multi": True,  # Allow multiple selections
+    "includeAll": True,  # Include 'All' option
+    "sort": 0,
+    "current": {},
+    "skipUrlSync": False,
+    "multiFormat": "regex",
+    "allValue": ".*"
+}
+
+
+def _build_dimension_panels(prepared, dimension_column):
+    """
+    Builds the panels of a dimension column: its anomalies count bar chart, and the anomalies score
+    and series decomposition panels repeated for each value of its variable.
+
+    Parameters:
+    - prepared (PreparedBase): The base query prepared by `prepare_base`.
+    - dimension_column (str): The name of the dimension column.
+
+    Returns:
+    - panels (tuple): The bar chart, anomalies score and series decomposition panels of the dimension.
+    """
+
+    from anomaly_detection import (
+        generate_series_decomposition_query,
+        generate_series_decompose_anomalies_query,
+        generate_anomaly_count_bar_chart,
+    )
+    from dashboard import Panel
+
+    variable_name = dimension_column
+
+    # Anomalies Count Bar Chart Panel
+    bar_chart_panel = Panel(
+        query=generate_anomaly_count_bar_chart(prepared, dimension_column=dimension_column),
+        title=f'Anomalies Count by {variable_name}',
+        type='barchart',
+        repeat=None
+    )
+
+    # Render the title once, it is shared by the two repeated panels
+    title = f'{variable_name} - ${{{variable_name}}}'
+
+    # Series Decompose Anomalies Panel
+    anomaly_score_panel = Panel(
+        query=generate_series_decompose_anomalies_query(prepared, dimension_column=dimension_column),
+        title=title,
+        type='timeseries',
+        repeat=variable_name
+    )
+
+    # Series Decomposition Panel
+    series_decomposition_panel = Panel(
+        query=generate_series_decomposition_query(prepared, dimension_column=dimension_column),
+        title=title,
+        type='timeseries',
+        repeat=variable_name
+    )
+
+    return bar_chart_panel, anomaly_score_panel, series_decomposition_panel
 
 
 def main():
@@ -30,38 +83,72 @@ def main():
     - Generates variable definitions and queries for panels.
     - Calls the function to create a dashboard in Grafana.
     """
+    # Log timestamped messages, with the traceback of any error
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+
     try:
         # Ensure all necessary environment variables are set
-        required_env_vars = [
-            "APP_ID", "APP_KEY", "AUTHORITY_ID",
-            "API_TOKEN", "GRAFANA_URL", "DATASOURCE_NAME", "BASE_QUERY"
-        ]
-        for var in required_env_vars:
-            if not getattr(config, var, None):
-                raise EnvironmentError(f"Environment variable {var} not set.")
+        config.validate()
+
+        # Import the query and dashboard modules only once the configuration is valid,
+        # so a misconfigured run exits without loading the Kusto and HTTP client libraries
+        from anomaly_detection import (
+            generate_series_decomposition_query,
+            generate_series_decompose_anomalies_query,
+            generate_anomaly_count_per_segment_query,
+            generate_dimension_anomaly_barchart,
+            clear_query_cache,
+            prepare_base,
+        )
+        from dashboard import (
+            Panel,
+            create_dashboard,
+            add_row
+        )
+        from kusto_connection import (
+            get_query_columns_from_query,
+            get_all_table_names,
+            extract_table_name,
+            extract_dt,
+            get_dimension_values
+        )
 
         # Get the datasource name and base query from config
         datasource_name = config.DATASOURCE_NAME
         base_query = config.BASE_QUERY
 
         try:
-            # Get all table names from the Kusto database
-            table_names = get_all_table_names()
+            # Drop time steps and queries cached by a previous run so changed data is picked up
+            extract_dt.cache_clear()
+            clear_query_cache()
+
+            # Run the independent Kusto lookups concurrently, starting with the table names and the columns of the base_query
+            with ThreadPoolExecutor(max_workers=2) as executor:
+                table_names_future = executor.submit(get_all_table_names)
+                all_columns_future = executor.submit(get_query_columns_from_query, base_query)
+
+                # Extract table name from base_query
+                dashboard_title = extract_table_name(base_query, table_names_future.result())
+
+                all_columns = all_columns_future.result()
 
-            # Extract table name from base_query
-            dashboard_title = extract_table_name(base_query, table_names)
+                # Ensure there are at least two columns: time and value
+                if len(all_columns) < 2:
+                    logger.error("Not enough columns in query result.")
+                    return
 
-            # Get columns from the base_query
-            all_columns = get_query_columns_from_query(base_query)
+                # Extract dimension columns
+                dimension_columns = all_columns[2:] if len(all_columns) > 2 else []
+                columns = all_columns[:2]
 
-            # Ensure there are at least two columns: time and value
-            if len(all_columns) < 2:
-                print("Not enough columns in query result.")
-                return
+                # Fetch the values of all the dimension columns at once in the background,
+                # while the base query is prepared (which looks up its time step)
+                dimension_values_future = executor.submit(get_dimension_values, base_query, dimension_columns)
 
-            # Extract dimension columns
-            dimension_columns = all_columns[2:] if len(all_columns) > 2 else []
-            columns = all_columns[:2]
+                # Prepare the base query once for all the generated queries
+                prepared = prepare_base(base_query, columns)
+
+            dimension_values = dimension_values_future.result()
 
             # Initialize lists for variable definitions and queries
             variable_definitions = []
@@ -90,134 +177,101 @@ def main():
             add_row(queries_and_titles, 'Time Series Plot')
 
             # Generate time series plots queries without dimension filtering
-            query = generate_series_decomposition_query(base_query, columns)
+            query = generate_series_decomposition_query(prepared)
             title = f'Series Decomposition'
-            queries_and_titles.append({
-                'query': query,
-                'title': title,
-                'type': 'timeseries',
-                'repeat': None
-            })
+            queries_and_titles.append(Panel(
+                query=query,
+                title=title,
+                type='timeseries',
+                repeat=None
+            ))
 
             # Series Decompose Anomalies Panel
-            query_anomalies = generate_series_decompose_anomalies_query(base_query, columns)
+            query_anomalies = generate_series_decompose_anomalies_query(prepared)
             title_anomalies = f'Anomalies'
-            queries_and_titles.append({
-                'query': query_anomalies,
-                'title': title_anomalies,
-                'type': 'timeseries',
-                'repeat': None
-            })
-
-            # Add 'Anomalies Count Per Dimension' row
-            add_row(queries_and_titles, 'Anomalies Count Per Dimension')
-
-            # Generate Anomalies Count Per Dimension bar chart panel
-            query_anomalies_per_dim = generate_dimension_anomaly_barchart(base_query, columns, dimension_columns=dimension_columns)
-
-            if query_anomalies_per_dim:
-                title_anomalies_per_dim = f'Anomalies Per Dimension'
-                queries_and_titles.append({
-                    'query': query_anomalies_per_dim,
-                    'title': title_anomalies_per_dim,
-                    'type': 'barchart',
-                    'repeat': None
-                })
-
-            # Add 'Anomalies Count' row
-            add_row(queries_and_titles, 'Anomalies Count')
-
-            # Create variables for each dimension column
-            for dimension_column in dimension_columns:
-                variable_name = dimension_column
-
-                variable_definition = {
-                    "type": "query",
-                    "name": variable_name,
-                    "hide": 0,
-                    "datasource": {"type": "grafana-azure-data-explorer-datasource", "uid": datasource_name},
-                    "refresh": "",
-                    "multi": True,  # Allow multiple selections
-                    "includeAll": True,  # Include 'All' option
-                    "query": f"{base_query}\n| project {dimension_column} = tostring({dimension_column})\n| distinct {dimension_column}",
-                    "sort": 0,
-                    "current": {},
-                    "definition": f"{base_query}\n| project {dimension_column} = tostring({dimension_column})\n| distinct {dimension_column}",
-                    "label": variable_name,
-                    "skipUrlSync": False,
-                    "multiFormat": "regex",
-                    "allValue": ".*"
-                }
-
-                variable_definitions.append(variable_definition)
-
-                # Anomalies Count Bar Chart Panel
-                query_bar_chart = generate_anomaly_count_bar_chart(
-                    base_query, columns, dimension_column=dimension_column
-                )
-                title_bar_chart = f'Anomalies Count by {variable_name}'
-                queries_and_titles.append({
-                    'query': query_bar_chart,
-                    'title': title_bar_chart,
-                    'type': 'barchart',
-                    'repeat': None
-                })
-
-            # Add 'Anomalies Count Per Segment' row
-            add_row(queries_and_titles, 'Anomalies Count Per Segment')
-
-            # Anomaly Count per Segment Panel
-            anomaly_count_query = generate_anomaly_count_per_segment_query(
-                base_query, columns, dimension_columns=dimension_columns
-            )
-            if anomaly_count_query:
-                if len(dimension_columns) >= 2:
-                    title_anomaly_count = f'Anomaly Count per Segment by {", ".join(dimension_columns)}'
-                else: 
-                    # one dimension
-                    title_anomaly_count = f'Anomaly Count by {dimension_columns[0]}'
-                queries_and_titles.append({
-                    'query': anomaly_count_query,
-                    'title': title_anomaly_count,
-                    'type': 'table',
-                    'repeat': None 
-                })
-
-            # Add 'Anomalies Score' row
-            add_row(queries_and_titles, 'Anomalies Score')
-
-            for dimension_column in dimension_columns:
-                variable_name = dimension_column
-
-                # Series Decompose Anomalies Panel
-                query_anomalies = generate_series_decompose_anomalies_query(
-                    base_query, columns, dimension_column=dimension_column
-                )
-                title_anomalies = f'{variable_name} - ${{{variable_name}}}'
-                queries_and_titles.append({
-                    'query': query_anomalies,
-                    'title': title_anomalies,
-                    'type': 'timeseries',
-                    'repeat': variable_name
-                })
-
-            # Add 'Series Decomposition' row
-            add_row(queries_and_titles, 'Series Decomposition')
-
-            for dimension_column in dimension_columns:
-                variable_name = dimension_column
-
-                # Series Decomposition Panel
-                query = generate_series_decomposition_query(
-                    base_query, columns, dimension_column=dimension_column
+            queries_and_titles.append(Panel(
+                query=query_anomalies,
+                title=title_anomalies,
+                type='timeseries',
+                repeat=None
+            ))
+
+            # The remaining rows all break the series down by dimension, skip them when there is none
+            if dimension_columns:
+                # Add 'Anomalies Count Per Dimension' row
+                add_row(queries_and_titles, 'Anomalies Count Per Dimension')
+
+                # Generate Anomalies Count Per Dimension bar chart panel
+                query_anomalies_per_dim = generate_dimension_anomaly_barchart(prepared, dimension_columns=dimension_columns)
+
+                if query_anomalies_per_dim:
+                    title_anomalies_per_dim = f'Anomalies Per Dimension'
+                    queries_and_titles.append(Panel(
+                        query=query_anomalies_per_dim,
+                        title=title_anomalies_per_dim,
+                        type='barchart',
+                        repeat=None
+                    ))
+
+                # Build the panels of each dimension, grouped by the row they belong to
+                bar_chart_panels, anomaly_score_panels, series_decomposition_panels = zip(*(
+                    _build_dimension_panels(prepared, dimension_column)
+                    for dimension_column in dimension_columns
+                ))
+
+                # Add 'Anomalies Count' row
+                add_row(queries_and_titles, 'Anomalies Count')
+
+                # Create variables for each dimension column
+                for dimension_column in dimension_columns:
+                    variable_name = dimension_column
+
+                    # Values are frozen at generation time, so Grafana never queries ADX for them
+                    values = dimension_values[dimension_column]
+
+                    # Grafana splits the query of a custom variable on unescaped commas and only un-escapes "\,".
+                    # Known limitations: a value ending in a backslash merges with the next value, and a value
+                    # containing " : " is read as a "text : value" pair
+                    variable_definition = {
+                        **_DIMENSION_VARIABLE_TEMPLATE,
+                        "name": variable_name,
+                        "label": variable_name,
+                        "query": ",".join(value.replace(",", "\\,") for value in values),
+                        "options": [{"text": value, "value": value, "selected": False} for value in values]
+                    }
+
+                    variable_definitions.append(variable_definition)
+
+                # Anomalies Count Bar Chart Panels
+                queries_and_titles.extend(bar_chart_panels)
+
+                # Add 'Anomalies Count Per Segment' row
+                add_row(queries_and_titles, 'Anomalies Count Per Segment')
+
+                # Anomaly Count per Segment Panel
+                anomaly_count_query = generate_anomaly_count_per_segment_query(
+                    prepared, dimension_columns=dimension_columns
                 )
-                title = f'{variable_name} - ${{{variable_name}}}'
-                queries_and_titles.append({
-                    'query': query,
-                    'title': title,
-                    'type': 'timeseries',
-                    'repeat': variable_name
-                })
+                if anomaly_count_query:
+                    if len(dimension_columns) >= 2:
+                        title_anomaly_count = f'Anomaly Count per Segment by {", ".join(dimension_columns)}'
+                    else: 
+                        # one dimension
+                        title_anomaly_count = f'Anomaly Count by {dimension_columns[0]}'
+                    queries_and_titles.append(Panel(
+                        query=anomaly_count_query,
+                        title=title_anomaly_count,
+                        type='table',
+                        repeat=None
+                    ))
+
+                # Add 'Anomalies Score' row
+                add_row(queries_and_titles, 'Anomalies Score')
+                queries_and_titles.extend(anomaly_score_panels)
+
+                # Add 'Series Decomposition' row
+                add_row(queries_and_titles, 'Series Decomposition')
+                queries_and_titles.extend(series_decomposition_panels)
 
             # Call create_dashboard function to generate the dashboard in Grafana
             create_dashboard(
@@ -230,11 +284,11 @@ def main():
 
         except Exception as e:
             # Logs the error during processing of the query
-            print(f"An error occurred while processing the query: {e}")
+            logger.exception("An error occurred while processing the query: %s", e)
 
     except Exception as e:
         # Handles errors occurring during the initial setup or outside query processing.
-        print(f"An exception occurred: {e}")
+        logger.exception("An exception occurred: %s", e)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file